@@ -1,6 +1,6 @@
 import streamlit as st
 import os
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
 
@@ -9,6 +9,17 @@ import vertexai
 from google.oauth2 import service_account
 from vertexai import agent_engines
 
+from common import (
+    MAX_TURNS,
+    batch_stream,
+    display_conversation_history,
+    last_text_preview,
+    load_local_history,
+    messages_from_events,
+    render_session_table,
+    save_local_history,
+)
+
 # Carica variabili da .env (opzionale)
 load_dotenv()
 
@@ -21,52 +32,40 @@ RESOURCE_ID = os.getenv(
 )
 
 
-def initialize_vertex_ai() -> bool:
-    """Inizializza Vertex AI usando credenziali da st.secrets (se presenti) oppure ADC."""
-    try:
-        credentials = None
-        # Se hai inserito la chiave del service account in .streamlit/secrets.toml
-        if "gcp_service_account" in st.secrets:
-            credentials = service_account.Credentials.from_service_account_info(
-                st.secrets["gcp_service_account"]
-            )
+@st.cache_resource
+def _init_vertex() -> bool:
+    """Inizializza Vertex AI usando credenziali da st.secrets (se presenti) oppure ADC.
 
-        if credentials:
-            vertexai.init(project=PROJECT_ID, location=LOCATION, credentials=credentials)
-        else:
-            # Fallback a ADC (GOOGLE_APPLICATION_CREDENTIALS o gcloud auth application-default login)
-            vertexai.init(project=PROJECT_ID, location=LOCATION)
-
-        return True
-    except Exception as e:
-        st.error(f"Errore nell'inizializzazione di Vertex AI: {e}")
-        return False
+    cache_resource: parsing credenziali e vertexai.init sono costi one-shot,
+    non vanno ripagati ad ogni rerun. Le eccezioni non vengono messe in cache,
+    quindi un init fallito viene ritentato al rerun successivo.
+    """
+    credentials = None
+    # Se hai inserito la chiave del service account in .streamlit/secrets.toml
+    if "gcp_service_account" in st.secrets:
+        credentials = service_account.Credentials.from_service_account_info(
+            st.secrets["gcp_service_account"]
+        )
 
+    if credentials:
+        vertexai.init(project=PROJECT_ID, location=LOCATION, credentials=credentials)
+    else:
+        # Fallback a ADC (GOOGLE_APPLICATION_CREDENTIALS o gcloud auth application-default login)
+        vertexai.init(project=PROJECT_ID, location=LOCATION)
 
-# ---------- Utility ----------
-def _format_timestamp(ts: Any) -> str:
-    """Gestione robusta di epoch sec/ms o stringhe ISO8601."""
-    try:
-        if isinstance(ts, (int, float)):
-            # euristica: se è in millisecondi
-            if ts > 1e12:
-                ts = ts / 1000.0
-            return datetime.fromtimestamp(ts).strftime('%d/%m %H:%M')
-        elif isinstance(ts, str):
-            s = ts.replace("Z", "+00:00")
-            # datetime.fromisoformat supporta il formato con offset
-            dt = datetime.fromisoformat(s)
-            return dt.strftime('%d/%m %H:%M')
-    except Exception:
-        pass
-    return "Sconosciuto"
+    return True
 
 
 # ---------- Operazioni Agent Engine ----------
-def create_new_session(resource_id: str, user_id: str) -> Optional[str]:
+@st.cache_resource
+def get_remote_app(resource_id: str):
+    """Recupera l'handle dell'agente remoto una sola volta (riusato tra i rerun)."""
+    return agent_engines.get(resource_id)
+
+
+def create_new_session(remote_app, user_id: str) -> Optional[str]:
     """Crea una nuova sessione e ritorna l'ID della sessione."""
     try:
-        remote_app = agent_engines.get(resource_id)
         remote_session = remote_app.create_session(user_id=user_id)
         if isinstance(remote_session, str):
             return remote_session
@@ -79,10 +78,9 @@ def create_new_session(resource_id: str, user_id: str) -> Optional[str]:
         return None
 
 
-def get_sessions_list(resource_id: str, user_id: str) -> List[Dict[str, Any]]:
+def get_sessions_list(remote_app, user_id: str) -> List[Dict[str, Any]]:
     """Lista le sessioni dell'utente."""
     try:
-        remote_app = agent_engines.get(resource_id)
         sessions = remote_app.list_sessions(user_id=user_id)
         if isinstance(sessions, dict) and 'sessions' in sessions:
             return sessions['sessions']
@@ -95,10 +93,9 @@ def get_sessions_list(resource_id: str, user_id: str) -> List[Dict[str, Any]]:
         return []
 
 
-def get_session_details(resource_id: str, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+def get_session_details(remote_app, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
     """Dettagli della sessione inclusa la history conversazionale."""
     try:
-        remote_app = agent_engines.get(resource_id)
         session = remote_app.get_session(user_id=user_id, session_id=session_id)
         if isinstance(session, dict):
             return session
@@ -109,10 +106,9 @@ def get_session_details(resource_id: str, user_id: str, session_id: str) -> Opti
         return None
 
 
-def delete_session_by_id(resource_id: str, user_id: str, session_id: str) -> bool:
+def delete_session_by_id(remote_app, user_id: str, session_id: str) -> bool:
     """Elimina una sessione per ID."""
     try:
-        remote_app = agent_engines.get(resource_id)
         remote_app.delete_session(user_id=user_id, session_id=session_id)
         return True
     except Exception as e:
@@ -120,60 +116,135 @@ def delete_session_by_id(resource_id: str, user_id: str, session_id: str) -> boo
         return False
 
 
-def send_message_to_agent(resource_id: str, user_id: str, session_id: str, message: str) -> List[str]:
-    """Invia un messaggio all'agente e restituisce le risposte (streaming)."""
+def stream_message_to_agent(remote_app, user_id: str, session_id: str, message: str):
+    """Invia un messaggio all'agente e genera i chunk di testo man mano che arrivano."""
     try:
-        remote_app = agent_engines.get(resource_id)
-        responses: List[str] = []
-
         for event in remote_app.stream_query(
             user_id=user_id,
             session_id=session_id,
             message=message,
         ):
-            # Estrai testo dall'evento
-            if isinstance(event, dict):
-                content = event.get('content', {})
-                if isinstance(content, dict):
-                    parts = content.get('parts', [])
-                    for part in parts:
-                        if isinstance(part, dict) and 'text' in part:
-                            text = part['text']
-                            if text and str(text).strip():
-                                responses.append(str(text))
-        return responses
+            # Happy path diretto: nessun isinstance né dict di default per evento;
+            # gli eventi senza testo (tool call, metadata) cadono nell'except
+            try:
+                for part in event["content"]["parts"]:
+                    text = part.get("text")
+                    if text:
+                        yield text
+            except (KeyError, TypeError, AttributeError):
+                continue
     except Exception as e:
         st.error(f"Errore durante l'invio del messaggio: {e}")
-        return []
-
-
-def display_conversation_history(session_details: Dict[str, Any]):
-    """Mostra la history della conversazione dagli eventi di sessione."""
-    events = session_details.get('events', [])
-    if not events:
-        st.info("Nessuna conversazione al momento. Invia un messaggio per iniziare!")
-        return
 
-    for event in events:
-        if isinstance(event, dict):
-            content = event.get('content', {})
-            author = event.get('author', 'unknown')
-            if isinstance(content, dict):
-                parts = content.get('parts', [])
-                role = content.get('role', author)
 
-                text_content = ""
-                for part in parts:
-                    if isinstance(part, dict) and 'text' in part and part['text'] is not None:
-                        text_content += str(part['text'])
+@st.cache_data(ttl=30, show_spinner=False)
+def _cached_sessions(resource_id: str, user_id: str) -> List[Dict[str, Any]]:
+    """Lista sessioni con cache TTL: evita una chiamata Vertex per ogni rerun."""
+    return get_sessions_list(get_remote_app(resource_id), user_id)
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _cached_session_details(resource_id: str, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+    """Dettagli sessione con cache TTL, invalidata su create/delete/invio messaggio."""
+    return get_session_details(get_remote_app(resource_id), user_id, session_id)
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _session_previews(resource_id: str, user_id: str, session_ids: tuple) -> Dict[str, str]:
+    """Anteprima (ultimo messaggio) per ogni sessione, recuperata in parallelo.
+
+    Chiamate I/O-bound: il fan-out su thread sovrappone i round trip verso
+    Vertex; l'handle remote_app in cache è condiviso tra i worker.
+    """
+    remote_app = get_remote_app(resource_id)
+
+    def _preview(session_id: str) -> str:
+        # Chiamata SDK diretta, senza get_session_details: i worker non hanno
+        # ScriptRunContext, quindi niente st.error da qui. Gli errori
+        # degradano a un'anteprima vuota.
+        try:
+            session = remote_app.get_session(user_id=user_id, session_id=session_id)
+            if isinstance(session, dict):
+                return last_text_preview(session)
+        except Exception:
+            pass
+        return ""
+
+    if not session_ids:
+        return {}
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        return dict(zip(session_ids, ex.map(_preview, session_ids)))
+
+
+@st.fragment
+def _chat_area(remote_app, user_id: str):
+    """Area chat come fragment: i rerun innescati da chat_input restano qui dentro.
+
+    Inviare un messaggio non riesegue sidebar e resto della pagina: solo i
+    messaggi locali (già appiattiti) vengono ri-emessi.
+    """
+    st.subheader(f"Sessione: {st.session_state.session_id}")
+
+    # Il log locale è autoritativo: si va al server solo se la sessione non è
+    # mai stata vista o su sync esplicito
+    if st.session_state.last_loaded_session_id != st.session_state.session_id:
+        local_messages = st.session_state.local_history.get(st.session_state.session_id)
+        if local_messages is not None:
+            st.session_state.messages = local_messages
+            st.session_state.last_loaded_session_id = st.session_state.session_id
+        else:
+            session_details = _cached_session_details(RESOURCE_ID, user_id, st.session_state.session_id)
+            if session_details:
+                st.session_state.messages = messages_from_events(st.session_state.session_id, session_details)
+                st.session_state.last_loaded_session_id = st.session_state.session_id
+            else:
+                st.error("Impossibile caricare i dettagli della sessione. Riprova ad aggiornare o crea una nuova sessione.")
+                st.session_state.messages = []
+
+    if st.button("🔁 Sincronizza col server", help="Ricarica la history della sessione dal backend"):
+        session_details = get_session_details(remote_app, user_id, st.session_state.session_id)
+        if session_details:
+            st.session_state.messages = messages_from_events(st.session_state.session_id, session_details)
+            st.session_state.local_history[st.session_state.session_id] = st.session_state.messages
+            save_local_history(user_id, st.session_state.local_history)
+            st.session_state.last_loaded_session_id = st.session_state.session_id
+
+    display_conversation_history(
+        st.session_state.messages,
+        empty_message="Nessuna conversazione al momento. Invia un messaggio per iniziare!",
+        truncation_fmt="[{n} messaggi precedenti troncati]",
+    )
 
-                if text_content.strip():
-                    if role == 'user' or author == 'user':
-                        with st.chat_message("user"):
-                            st.write(text_content)
-                    else:
-                        with st.chat_message("assistant"):
-                            st.write(text_content)
+    st.markdown("---")
+    user_message = st.chat_input("Scrivi qui il tuo messaggio...")
+    if user_message:
+        # Mostra subito il messaggio utente
+        with st.chat_message("user"):
+            st.write(user_message)
+
+        # Risposta agente (streaming incrementale, token per token)
+        with st.chat_message("assistant"):
+            full_response = st.write_stream(
+                batch_stream(
+                    stream_message_to_agent(
+                        remote_app, user_id, st.session_state.session_id, user_message
+                    )
+                )
+            )
+            if not full_response:
+                st.error("Nessuna risposta ricevuta dall'agente.")
+
+        # Aggiorna la history locale: nessun rerun, nessun rifetch dal server
+        st.session_state.messages.append({"role": "user", "content": user_message})
+        if full_response:
+            st.session_state.messages.append({"role": "assistant", "content": full_response})
+        st.session_state.messages = st.session_state.messages[-MAX_TURNS:]
+        # Persisti la history locale: warm start anche dopo un restart di Streamlit
+        st.session_state.local_history[st.session_state.session_id] = st.session_state.messages
+        save_local_history(user_id, st.session_state.local_history)
+        # Solo i dettagli in cache di questa sessione sono stale; le anteprime
+        # scadono col loro TTL. Un clear globale rifarebbe il fetch di tutto.
+        _cached_session_details.clear(RESOURCE_ID, user_id, st.session_state.session_id)
 
 
 def main():
@@ -185,10 +256,16 @@ def main():
     st.title("Assistente documenti di bilancio")
     st.markdown("")
 
-    # Inizializzazione Vertex AI con il tuo progetto/region
-    if not initialize_vertex_ai():
+    # Inizializzazione Vertex AI con il tuo progetto/region (una sola volta)
+    try:
+        _init_vertex()
+    except Exception as e:
+        st.error(f"Errore nell'inizializzazione di Vertex AI: {e}")
         st.stop()
 
+    # Handle dell'agente remoto, risolto una sola volta e riusato tra i rerun
+    remote_app = get_remote_app(RESOURCE_ID)
+
     # Stato della sessione
     if "session_id" not in st.session_state:
         st.session_state.session_id = None
@@ -198,23 +275,46 @@ def main():
         st.session_state.refresh_sessions = True
     if "user_name" not in st.session_state:
         st.session_state.user_name = "test_user"
+    if "messages" not in st.session_state:
+        st.session_state.messages = []
+    if "last_loaded_session_id" not in st.session_state:
+        st.session_state.last_loaded_session_id = None
+    if "local_history" not in st.session_state:
+        st.session_state.local_history = load_local_history(st.session_state.user_name)
 
     # Sidebar: gestione sessioni
     with st.sidebar:
-        user_id = st.text_input("Utente", value=st.session_state.user_name)
-        st.session_state.user_name = user_id
+        # Form: il cambio utente parte solo al submit, non ad ogni keystroke/rerun
+        with st.form("user_form"):
+            user_id_input = st.text_input("Utente", value=st.session_state.user_name)
+            submitted = st.form_submit_button("Applica")
+        if submitted and user_id_input != st.session_state.user_name:
+            st.session_state.user_name = user_id_input
+            st.session_state.refresh_sessions = True
+            st.session_state.local_history = load_local_history(user_id_input)
+            # Azzera selezione e conversazione in memoria del vecchio utente:
+            # sessioni e history appartengono al nuovo utente
+            st.session_state.session_id = None
+            st.session_state.messages = []
+            st.session_state.last_loaded_session_id = None
+        user_id = st.session_state.user_name
         st.header("Gestione sessioni")
 
         if st.button("🔄 Aggiorna sessioni"):
+            # Il refresh esplicito deve scavalcare il TTL, non rileggere la cache
+            _cached_sessions.clear(RESOURCE_ID, user_id)
             st.session_state.refresh_sessions = True
 
         if st.session_state.refresh_sessions:
-            st.session_state.sessions = get_sessions_list(RESOURCE_ID, user_id)
+            st.session_state.sessions = _cached_sessions(RESOURCE_ID, user_id)
             st.session_state.refresh_sessions = False
 
         if st.button("➕ Crea nuova sessione"):
-            new_session_id = create_new_session(RESOURCE_ID, user_id)
+            new_session_id = create_new_session(remote_app, user_id)
             if new_session_id:
+                # La lista sessioni è cambiata; le anteprime si ri-chiavano
+                # sulla nuova tupla di id
+                _cached_sessions.clear(RESOURCE_ID, user_id)
                 st.success(f"Nuova sessione creata: {new_session_id}")
                 st.session_state.session_id = new_session_id
                 st.session_state.refresh_sessions = True
@@ -222,58 +322,32 @@ def main():
 
         if st.session_state.sessions:
             st.subheader("Sessioni disponibili")
-            for i, session in enumerate(st.session_state.sessions):
-                session_id = session.get('id', f'session_{i}')
-                last_update = session.get('lastUpdateTime', 0)
-                last_update_str = _format_timestamp(last_update)
-
-                col1, col2 = st.columns([3, 1])
-                with col1:
-                    if st.button(f"📝 {session_id[:8]}... ({last_update_str})",
-                                 key=f"select_{session_id}"):
-                        st.session_state.session_id = session_id
-                        st.rerun()
-                with col2:
-                    if st.button("🗑️", key=f"delete_{session_id}", help="Elimina sessione"):
-                        if delete_session_by_id(RESOURCE_ID, user_id, session_id):
-                            st.success("Sessione eliminata!")
-                            if st.session_state.session_id == session_id:
-                                st.session_state.session_id = None
-                            st.session_state.refresh_sessions = True
-                            st.rerun()
+            previews = _session_previews(
+                RESOURCE_ID, user_id,
+                tuple(s.get('id', f'session_{i}') for i, s in enumerate(st.session_state.sessions)),
+            )
+            selected_id = render_session_table(
+                st.session_state.sessions, previews, fallback="Sconosciuto"
+            )
+            if selected_id and selected_id != st.session_state.session_id:
+                st.session_state.session_id = selected_id
+                st.rerun()
+
+            if st.button("🗑️ Elimina selezionata", disabled=selected_id is None):
+                if selected_id and delete_session_by_id(remote_app, user_id, selected_id):
+                    _cached_sessions.clear(RESOURCE_ID, user_id)
+                    _cached_session_details.clear(RESOURCE_ID, user_id, selected_id)
+                    st.success("Sessione eliminata!")
+                    if st.session_state.session_id == selected_id:
+                        st.session_state.session_id = None
+                    st.session_state.refresh_sessions = True
+                    st.rerun()
         else:
             st.info("Nessuna sessione trovata. Crea una nuova sessione per iniziare!")
 
     # Area chat principale
     if st.session_state.session_id:
-        st.subheader(f"Sessione: {st.session_state.session_id}")
-
-        session_details = get_session_details(RESOURCE_ID, user_id, st.session_state.session_id)
-        if session_details:
-            display_conversation_history(session_details)
-
-            st.markdown("---")
-            user_message = st.chat_input("Scrivi qui il tuo messaggio...")
-            if user_message:
-                # Mostra subito il messaggio utente
-                with st.chat_message("user"):
-                    st.write(user_message)
-
-                # Risposta agente (streaming aggregato)
-                with st.chat_message("assistant"):
-                    with st.spinner("Sto pensando..."):
-                        responses = send_message_to_agent(
-                            RESOURCE_ID, user_id, st.session_state.session_id, user_message
-                        )
-                        if responses:
-                            for response in responses:
-                                st.write(response)
-                        else:
-                            st.error("Nessuna risposta ricevuta dall'agente.")
-                # Aggiorna la history
-                st.rerun()
-        else:
-            st.error("Impossibile caricare i dettagli della sessione. Riprova ad aggiornare o crea una nuova sessione.")
+        _chat_area(remote_app, user_id)
     else:
         st.info("👈 Seleziona o crea una sessione dalla sidebar per iniziare a chattare.")
 
@@ -1,11 +1,30 @@
 
 import streamlit as st
 import os
-from datetime import datetime
 from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
-import requests
-import json
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import httpx
+
+# Parsing JSON C-level per il loop SSE (~2-5x più veloce dello stdlib),
+# con fallback a json se orjson non è installato
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
+from common import (
+    MAX_TURNS,
+    batch_stream,
+    display_conversation_history,
+    last_text_preview,
+    load_local_history,
+    messages_from_events,
+    render_session_table,
+    save_local_history,
+)
 
 # Carica variabili da .env
 load_dotenv()
@@ -25,22 +44,22 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
-# ---------- Utility ----------
-def _format_timestamp(ts: Any) -> str:
-    try:
-        if isinstance(ts, (int, float)):
-            if ts > 1e12:
-                ts = ts / 1000.0
-            return datetime.fromtimestamp(ts).strftime('%d/%m %H:%M')
-        elif isinstance(ts, str):
-            s = ts.replace("Z", "+00:00")
-            dt = datetime.fromisoformat(s)
-            return dt.strftime('%d/%m %H:%M')
-    except Exception:
-        pass
-    return "Unknown"
 
-def _parse_json_or_empty(response: requests.Response, on_empty=None):
+@st.cache_resource
+def _http() -> httpx.Client:
+    """Client HTTP condiviso con keep-alive e pool di connessioni.
+
+    Le connessioni restano aperte tra i rerun: niente handshake TCP+TLS
+    per ogni chiamata di servizio o stream SSE.
+    """
+    transport = httpx.HTTPTransport(
+        retries=3,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=20),
+    )
+    return httpx.Client(transport=transport, headers=HEADERS, timeout=30.0)
+
+# ---------- Utility ----------
+def _parse_json_or_empty(response: httpx.Response, on_empty=None):
     """
     Ritorna JSON se possibile.
     - Se 204/empty body -> on_empty (default: []), senza errori.
@@ -73,10 +92,10 @@ def list_apps():
     """GET /list-apps"""
     endpoint = f"{BASE_URL}/list-apps"
     try:
-        resp = requests.get(endpoint, headers=HEADERS)
+        resp = _http().get(endpoint)
         resp.raise_for_status()
         return _parse_json_or_empty(resp, on_empty=[])
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         st.error(f"Error listing apps: {e}")
         return None
 
@@ -87,14 +106,14 @@ def list_sessions(app_name: str, user_id: str) -> List[Dict[str, Any]]:
     """GET /apps/{app_name}/users/{user_id}/sessions"""
     endpoint = f"{BASE_URL}/apps/{app_name}/users/{user_id}/sessions"
     try:
-        resp = requests.get(endpoint, headers=HEADERS)
+        resp = _http().get(endpoint)
         resp.raise_for_status()
         data = _parse_json_or_empty(resp, on_empty=[])
         # Alcune API restituiscono {"sessions": [...]}
         if isinstance(data, dict) and "sessions" in data:
             return data["sessions"] or []
         return data if isinstance(data, list) else []
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         st.error(f"Error listing sessions for user {user_id} in app {app_name}: {e}")
         return []
 
@@ -102,11 +121,11 @@ def get_session(app_name: str, user_id: str, session_id: str) -> Optional[Dict[s
     """GET /apps/{app_name}/users/{user_id}/sessions/{session_id}"""
     endpoint = f"{BASE_URL}/apps/{app_name}/users/{user_id}/sessions/{session_id}"
     try:
-        resp = requests.get(endpoint, headers=HEADERS)
+        resp = _http().get(endpoint)
         resp.raise_for_status()
         data = _parse_json_or_empty(resp, on_empty=None)
         return data if isinstance(data, dict) else None
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         st.error(f"Error getting session {session_id}: {e}")
         return None
 
@@ -114,14 +133,14 @@ def delete_session(app_name: str, user_id: str, session_id: str) -> bool:
     """DELETE /apps/{app_name}/users/{user_id}/sessions/{session_id}"""
     endpoint = f"{BASE_URL}/apps/{app_name}/users/{user_id}/sessions/{session_id}"
     try:
-        resp = requests.delete(endpoint, headers=HEADERS)
+        resp = _http().delete(endpoint)
         # Alcune API rispondono 204 (No Content)
         if resp.status_code in [200, 202, 204]:
             return True
         # Prova a leggere eventuale JSON di errore per diagnosi
         _ = _parse_json_or_empty(resp, on_empty=None)
-        return resp.ok
-    except requests.exceptions.RequestException as e:
+        return resp.is_success
+    except httpx.HTTPError as e:
         st.error(f"Error deleting session {session_id}: {e}")
         return False
 
@@ -130,7 +149,7 @@ def create_session(app_name: str, user_id: str, session_data: Optional[dict] = N
     endpoint = f"{BASE_URL}/apps/{app_name}/users/{user_id}/sessions"
     try:
         payload = session_data if session_data is not None else {}
-        resp = requests.post(endpoint, headers=HEADERS, json=payload)
+        resp = _http().post(endpoint, json=payload)
         resp.raise_for_status()
         data = _parse_json_or_empty(resp, on_empty=None)
         if isinstance(data, dict):
@@ -144,15 +163,23 @@ def create_session(app_name: str, user_id: str, session_data: Optional[dict] = N
                 return maybe["id"]
         st.warning("La risposta alla creazione sessione non contiene un campo 'id'.")
         return None
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         st.error(f"Error creating session for user {user_id} in app {app_name}: {e}")
         return None
 
 # ****************************************
 # Agent Operations
 # ****************************************
+_SSE_DATA_PREFIX = b"data: "
+
 def agent_run_sse(app_name: str, user_id: str, session_id: str, query: str):
-    """POST /run_sse (Server-Sent Events)"""
+    """POST /run_sse (Server-Sent Events).
+
+    Producer-consumer: un thread dedicato legge e parsa lo stream SSE in una
+    queue, così l'I/O di rete si sovrappone al rendering della UI invece di
+    bloccarlo. Warning/errori viaggiano sulla stessa queue e vengono emessi
+    dal thread principale (st.* non va chiamato dai worker).
+    """
     endpoint = f"{BASE_URL}/run_sse"
     request_data = {
         "app_name": app_name,
@@ -164,45 +191,165 @@ def agent_run_sse(app_name: str, user_id: str, session_id: str, query: str):
         },
         "stream": True
     }
-    try:
-        with requests.post(endpoint, headers=HEADERS, json=request_data, stream=True) as response:
-            response.raise_for_status()
-            for line in response.iter_lines():
-                if line:
-                    decoded_line = line.decode('utf-8')
-                    if decoded_line.startswith("data: "):
-                        try:
-                            yield json.loads(decoded_line[len("data: "):])
-                        except json.JSONDecodeError:
-                            st.warning(f"Could not decode JSON from stream: {decoded_line}")
-                    # Altri tipi di righe (commenti/keepalive) sono ignorati
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error during agent run SSE: {e}")
-        return
-
-def display_conversation_history(session_details: Dict[str, Any]):
-    events = session_details.get('events', [])
-    if not events:
-        st.info("No conversation history yet. Start by sending a message!")
-        return
-    for event in events:
-        if isinstance(event, dict):
-            content = event.get('content', {})
-            author = event.get('author', 'unknown')
-            if isinstance(content, dict):
-                parts = content.get('parts', [])
-                role = content.get('role', author)
-                text_content = ""
-                for part in parts:
-                    if isinstance(part, dict) and 'text' in part and part['text'] is not None:
-                        text_content += part['text']
-                if text_content.strip():
-                    if role == 'user' or author == 'user':
-                        with st.chat_message("user"):
-                            st.write(text_content)
-                    else:
-                        with st.chat_message("assistant"):
-                            st.write(text_content)
+    q: queue.Queue = queue.Queue(maxsize=256)
+
+    def _producer():
+        try:
+            # Niente read timeout sullo stream: tra un evento SSE e il
+            # successivo possono passare minuti (tool call lato agente);
+            # connect/write/pool restano ai 30s del client.
+            stream_timeout = httpx.Timeout(30.0, read=None)
+            with _http().stream("POST", endpoint, json=request_data, timeout=stream_timeout) as response:
+                response.raise_for_status()
+                # Lavora direttamente sui byte: niente decode utf-8 per riga,
+                # orjson/json accettano bytes. Si decodifica solo in diagnostica.
+                # iter_bytes (a differenza di iter_raw) applica comunque il
+                # content-decoding gzip/br negoziato da Accept-Encoding.
+                buffer = b""
+                for chunk in response.iter_bytes():
+                    buffer += chunk
+                    while True:
+                        nl = buffer.find(b"\n")
+                        if nl < 0:
+                            break
+                        line = buffer[:nl].rstrip(b"\r")
+                        buffer = buffer[nl + 1:]
+                        if line.startswith(_SSE_DATA_PREFIX):
+                            try:
+                                q.put(("event", _json_loads(line[len(_SSE_DATA_PREFIX):])))
+                            except ValueError:
+                                q.put((
+                                    "warning",
+                                    f"Could not decode JSON from stream: {line.decode('utf-8', 'replace')}",
+                                ))
+                        # Altri tipi di righe (commenti/keepalive) sono ignorati
+        except httpx.HTTPError as e:
+            q.put(("error", f"Error during agent run SSE: {e}"))
+        finally:
+            q.put(("end", None))
+
+    threading.Thread(target=_producer, daemon=True).start()
+    while True:
+        kind, payload = q.get()
+        if kind == "event":
+            yield payload
+        elif kind == "warning":
+            st.warning(payload)
+        elif kind == "error":
+            st.error(payload)
+        else:  # "end"
+            break
+
+def stream_agent_text(app_name: str, user_id: str, session_id: str, query: str):
+    """Genera i chunk di testo estratti dagli eventi SSE, pronti per st.write_stream."""
+    for event in agent_run_sse(app_name, user_id, session_id, query):
+        # Happy path diretto: gli eventi senza testo cadono nell'except
+        try:
+            for part in event["content"]["parts"]:
+                text = part.get("text")
+                if text:
+                    yield text
+        except (KeyError, TypeError, AttributeError):
+            continue
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _cached_sessions(app_name: str, user_id: str) -> List[Dict[str, Any]]:
+    """Session list with a TTL cache: avoids one HTTP call per rerun."""
+    return list_sessions(app_name, user_id)
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _cached_session_details(app_name: str, user_id: str, session_id: str) -> Optional[Dict[str, Any]]:
+    """Session details with a TTL cache, invalidated on create/delete/send."""
+    return get_session(app_name, user_id, session_id)
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _session_previews(app_name: str, user_id: str, session_ids: tuple) -> Dict[str, str]:
+    """Anteprima (ultimo messaggio) per ogni sessione, recuperata in parallelo.
+
+    Le chiamate sono I/O-bound: il fan-out su thread sovrappone i round trip
+    HTTP; il pool della sessione condivisa (pool_maxsize=20) copre i worker.
+    """
+    def _preview(session_id: str) -> str:
+        # Fetch "grezzo", senza passare da get_session: i worker non hanno
+        # ScriptRunContext, quindi niente st.error da qui. Gli errori
+        # degradano a un'anteprima vuota.
+        endpoint = f"{BASE_URL}/apps/{app_name}/users/{user_id}/sessions/{session_id}"
+        try:
+            resp = _http().get(endpoint)
+            resp.raise_for_status()
+            details = resp.json()
+            if isinstance(details, dict):
+                return last_text_preview(details)
+        except Exception:
+            pass
+        return ""
+
+    if not session_ids:
+        return {}
+    with ThreadPoolExecutor(max_workers=8) as ex:
+        return dict(zip(session_ids, ex.map(_preview, session_ids)))
+
+@st.fragment
+def _chat_area(user_id: str):
+    """Chat area as a fragment: reruns triggered by chat_input stay in here.
+
+    Sending a message does not re-execute the sidebar or the rest of the page:
+    only the local (already flattened) messages are re-emitted.
+    """
+    st.subheader(f"Chat Session: {st.session_state.session_id}")
+
+    # The local log is authoritative: hit the server only for sessions never
+    # seen before or on explicit sync
+    if st.session_state.last_loaded_session_id != st.session_state.session_id:
+        local_messages = st.session_state.local_history.get(st.session_state.session_id)
+        if local_messages is not None:
+            st.session_state.messages = local_messages
+            st.session_state.last_loaded_session_id = st.session_state.session_id
+        else:
+            session_details = _cached_session_details(APP_NAME, user_id, st.session_state.session_id)
+            if session_details:
+                st.session_state.messages = messages_from_events(st.session_state.session_id, session_details)
+                st.session_state.last_loaded_session_id = st.session_state.session_id
+            else:
+                st.error("Could not load session details. Please try refreshing or creating a new session.")
+                st.session_state.messages = []
+
+    if st.button("🔁 Sync with server", help="Reload this session's history from the backend"):
+        session_details = get_session(APP_NAME, user_id, st.session_state.session_id)
+        if session_details:
+            st.session_state.messages = messages_from_events(st.session_state.session_id, session_details)
+            st.session_state.local_history[st.session_state.session_id] = st.session_state.messages
+            save_local_history(user_id, st.session_state.local_history)
+            st.session_state.last_loaded_session_id = st.session_state.session_id
+
+    display_conversation_history(st.session_state.messages)
+
+    st.markdown("---")
+    user_message = st.chat_input("Type your message here...")
+    if user_message:
+        with st.chat_message("user"):
+            st.write(user_message)
+
+        with st.chat_message("assistant"):
+            full_response = st.write_stream(
+                batch_stream(
+                    stream_agent_text(APP_NAME, user_id, st.session_state.session_id, user_message)
+                )
+            )
+            if not full_response:
+                st.error("No response received from the agent.")
+
+        # Update local history: no rerun, no re-fetch from the server
+        st.session_state.messages.append({"role": "user", "content": user_message})
+        if full_response:
+            st.session_state.messages.append({"role": "assistant", "content": full_response})
+        st.session_state.messages = st.session_state.messages[-MAX_TURNS:]
+        # Persist local history: warm start even after a Streamlit restart
+        st.session_state.local_history[st.session_state.session_id] = st.session_state.messages
+        save_local_history(user_id, st.session_state.local_history)
+        # Only this session's cached details are stale now; previews expire
+        # on their own TTL. A global clear would refetch every session.
+        _cached_session_details.clear(APP_NAME, user_id, st.session_state.session_id)
 
 def main():
     st.set_page_config(
@@ -222,11 +369,29 @@ def main():
         st.session_state.refresh_sessions = True
     if "user_name" not in st.session_state:
         st.session_state.user_name = "test_user"
+    if "messages" not in st.session_state:
+        st.session_state.messages = []
+    if "last_loaded_session_id" not in st.session_state:
+        st.session_state.last_loaded_session_id = None
+    if "local_history" not in st.session_state:
+        st.session_state.local_history = load_local_history(st.session_state.user_name)
 
     # Sidebar
     with st.sidebar:
-        user_id = st.text_input("User Name", value=st.session_state.user_name)
-        st.session_state.user_name = user_id
+        # Form: the user switch only kicks in on submit, not on every keystroke/rerun
+        with st.form("user_form"):
+            user_id_input = st.text_input("User Name", value=st.session_state.user_name)
+            submitted = st.form_submit_button("Apply")
+        if submitted and user_id_input != st.session_state.user_name:
+            st.session_state.user_name = user_id_input
+            st.session_state.refresh_sessions = True
+            st.session_state.local_history = load_local_history(user_id_input)
+            # Drop the previous user's selection and in-memory conversation:
+            # sessions (and their history) belong to the new user now
+            st.session_state.session_id = None
+            st.session_state.messages = []
+            st.session_state.last_loaded_session_id = None
+        user_id = st.session_state.user_name
         st.header("Session Management")
 
         # Diagnostica rapida API
@@ -235,7 +400,7 @@ def main():
             if st.button("Test /list-apps"):
                 try:
                     ep = f"{BASE_URL}/list-apps"
-                    r = requests.get(ep, headers=HEADERS)
+                    r = _http().get(ep)
                     st.write("Status:", r.status_code)
                     st.write("Content-Type:", r.headers.get("content-type"))
                     st.code(r.text[:1000] if r.text else "<no body>", language="text")
@@ -243,15 +408,19 @@ def main():
                     st.error(f"Errore test /list-apps: {e}")
 
         if st.button("🔄 Refresh Sessions"):
+            # Explicit refresh must bypass the TTL, not read the cached list
+            _cached_sessions.clear(APP_NAME, user_id)
             st.session_state.refresh_sessions = True
 
         if st.session_state.refresh_sessions:
-            st.session_state.sessions = list_sessions(APP_NAME, user_id)
+            st.session_state.sessions = _cached_sessions(APP_NAME, user_id)
             st.session_state.refresh_sessions = False
 
         if st.button("➕ Create New Session"):
             new_session_id = create_session(APP_NAME, user_id)
             if new_session_id:
+                # The session list changed; previews re-key on the new id tuple
+                _cached_sessions.clear(APP_NAME, user_id)
                 st.success(f"Created new session: {new_session_id}")
                 st.session_state.session_id = new_session_id
                 st.session_state.refresh_sessions = True
@@ -259,56 +428,30 @@ def main():
 
         if st.session_state.sessions:
             st.subheader("Available Sessions")
-            for i, session in enumerate(st.session_state.sessions):
-                session_id = session.get('id', f'session_{i}')
-                last_update = session.get('lastUpdateTime', 0)
-                last_update_str = _format_timestamp(last_update)
-
-                col1, col2 = st.columns([3, 1])
-                with col1:
-                    if st.button(f"📝 {session_id[:8]}... ({last_update_str})", key=f"select_{session_id}"):
-                        st.session_state.session_id = session_id
-                        st.rerun()
-                with col2:
-                    if st.button("🗑️", key=f"delete_{session_id}", help="Delete session"):
-                        if delete_session(APP_NAME, user_id, session_id):
-                            st.success("Session deleted!")
-                            if st.session_state.session_id == session_id:
-                                st.session_state.session_id = None
-                            st.session_state.refresh_sessions = True
-                            st.rerun()
+            previews = _session_previews(
+                APP_NAME, user_id,
+                tuple(s.get('id', f'session_{i}') for i, s in enumerate(st.session_state.sessions)),
+            )
+            selected_id = render_session_table(st.session_state.sessions, previews)
+            if selected_id and selected_id != st.session_state.session_id:
+                st.session_state.session_id = selected_id
+                st.rerun()
+
+            if st.button("🗑️ Delete selected", disabled=selected_id is None):
+                if selected_id and delete_session(APP_NAME, user_id, selected_id):
+                    _cached_sessions.clear(APP_NAME, user_id)
+                    _cached_session_details.clear(APP_NAME, user_id, selected_id)
+                    st.success("Session deleted!")
+                    if st.session_state.session_id == selected_id:
+                        st.session_state.session_id = None
+                    st.session_state.refresh_sessions = True
+                    st.rerun()
         else:
             st.info("No sessions found. Create a new session to start chatting!")
 
     # Main chat
     if st.session_state.session_id:
-        st.subheader(f"Chat Session: {st.session_state.session_id}")
-        session_details = get_session(APP_NAME, user_id, st.session_state.session_id)
-        if session_details:
-            display_conversation_history(session_details)
-
-            st.markdown("---")
-            user_message = st.chat_input("Type your message here...")
-            if user_message:
-                with st.chat_message("user"):
-                    st.write(user_message)
-
-                with st.chat_message("assistant"):
-                    with st.spinner("Thinking..."):
-                        responses = []
-                        for event in agent_run_sse(APP_NAME, user_id, st.session_state.session_id, user_message):
-                            if event and 'content' in event and 'parts' in event['content']:
-                                for part in event['content']['parts']:
-                                    if 'text' in part:
-                                        responses.append(part['text'])
-                        if responses:
-                            for response in responses:
-                                st.write(response)
-                        else:
-                            st.error("No response received from the agent.")
-                st.rerun()
-        else:
-            st.error("Could not load session details. Please try refreshing or creating a new session.")
+        _chat_area(user_id)
     else:
         st.info("👈 Please select or create a session from the sidebar to start chatting.")
 
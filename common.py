@@ -0,0 +1,218 @@
+"""Utility condivise tra app_agentEngine.py e app_local.py."""
+import os
+import time
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import pandas as pd
+import streamlit as st
+
+# Serializzazione C-level se disponibile, fallback allo stdlib
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    import json as _json
+
+    def _json_dumps(obj):
+        return _json.dumps(obj).encode("utf-8")
+
+    _json_loads = _json.loads
+
+# Finestra scorrevole sulla history: limita token inviati al backend e tempo di render
+MAX_TURNS = 40
+
+# Directory per la history locale su disco: warm start senza round trip al backend
+CACHE_DIR = ".cache"
+
+# Finestra di coalescenza dei token prima del flush verso la UI (millisecondi)
+STREAM_FLUSH_MS = float(os.getenv("LOCAL_STREAM_FLUSH_MS", "40"))
+
+
+def batch_stream(chunks: Iterable[str], flush_ms: Optional[float] = None) -> Iterator[str]:
+    """Coalesce i chunk di testo in finestre di ~flush_ms prima di cederli.
+
+    st.write_stream forza un aggiornamento di layout per ogni yield: sui
+    modelli a token veloci il collo di bottiglia è il render, non la rete.
+    Raggruppare i chunk ammortizza quel costo senza latenza percepibile.
+    """
+    flush_interval = (STREAM_FLUSH_MS if flush_ms is None else flush_ms) / 1000.0
+    buf: List[str] = []
+    last_flush = time.monotonic()
+    for chunk in chunks:
+        buf.append(chunk)
+        now = time.monotonic()
+        if now - last_flush > flush_interval:
+            yield "".join(buf)
+            buf.clear()
+            last_flush = now
+    if buf:
+        yield "".join(buf)
+
+
+def load_local_history(user_id: str) -> Dict[str, List[Dict[str, str]]]:
+    """Carica da disco la history {session_id: messages} dell'utente, se presente."""
+    path = os.path.join(CACHE_DIR, f"{user_id}.json")
+    try:
+        with open(path, "rb") as f:
+            data = _json_loads(f.read())
+        if isinstance(data, dict):
+            return data
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
+def save_local_history(user_id: str, history: Dict[str, List[Dict[str, str]]]) -> None:
+    """Scrive la history locale su disco (best effort, una write per turno, niente fsync)."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(os.path.join(CACHE_DIR, f"{user_id}.json"), "wb") as f:
+            f.write(_json_dumps(history))
+    except OSError:
+        pass
+
+
+@lru_cache(maxsize=4096)
+def _format_timestamp_cached(ts: Any, fallback: str) -> str:
+    try:
+        # Dispatch esplicito sul tipo: il caso epoch (il più comune) esce subito
+        # con un solo confronto, senza isinstance su tupla
+        if type(ts) is int or type(ts) is float:
+            # euristica: se è in millisecondi
+            if ts > 1e12:
+                ts = ts / 1000.0
+            return datetime.fromtimestamp(ts).strftime('%d/%m %H:%M')
+        elif type(ts) is str:
+            # replace solo se serve davvero
+            s = ts.replace("Z", "+00:00") if ts.endswith("Z") else ts
+            # datetime.fromisoformat supporta il formato con offset
+            dt = datetime.fromisoformat(s)
+            return dt.strftime('%d/%m %H:%M')
+    except Exception:
+        pass
+    return fallback
+
+
+def format_timestamp(ts: Any, fallback: str = "Unknown") -> str:
+    """Gestione robusta di epoch sec/ms o stringhe ISO8601, con cache sui valori già visti.
+
+    La sidebar riformatta gli stessi N timestamp ad ogni rerun: dopo il primo
+    render sono tutti cache hit. Il wrapper intercetta il TypeError che
+    lru_cache solleva per valori non hashabili (es. dict), che altrimenti
+    scavalcherebbe il try/except interno.
+    """
+    try:
+        return _format_timestamp_cached(ts, fallback)
+    except TypeError:
+        return fallback
+
+
+@st.cache_data(show_spinner=False)
+def flatten_events(session_id: str, events_len: int, _events: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+    """Appiattisce gli eventi in messaggi {role, content}, con cache su (session_id, n. eventi).
+
+    Solo eventi nuovi invalidano la chiave: rientrare in una sessione già vista è O(1).
+    """
+    messages: List[Dict[str, str]] = []
+    for event in _events:
+        if isinstance(event, dict):
+            content = event.get('content', {})
+            author = event.get('author', 'unknown')
+            if isinstance(content, dict):
+                parts = content.get('parts', [])
+                role = content.get('role', author)
+
+                # join lineare invece di += ripetuto: gli eventi streammati
+                # possono avere decine di parts
+                texts = [
+                    part['text'] for part in parts
+                    if isinstance(part, dict) and isinstance(part.get('text'), str)
+                ]
+                text_content = "".join(texts)
+
+                if text_content.strip():
+                    ui_role = "user" if (role == 'user' or author == 'user') else "assistant"
+                    messages.append({"role": ui_role, "content": text_content})
+    return messages
+
+
+def last_text_preview(session_details: Dict[str, Any], limit: int = 60) -> str:
+    """Ultimo testo della sessione, troncato, per le anteprime in sidebar.
+
+    Funzione pura senza st.*: usabile anche dai worker thread, dove manca
+    lo ScriptRunContext. Scorre gli eventi dal fondo e si ferma al primo
+    con del testo, senza appiattire tutta la history.
+    """
+    events = session_details.get('events', [])
+    for event in reversed(events):
+        if not isinstance(event, dict):
+            continue
+        content = event.get('content', {})
+        if not isinstance(content, dict):
+            continue
+        parts = content.get('parts', [])
+        texts = [str(part['text']) for part in parts
+                 if isinstance(part, dict) and part.get('text') is not None]
+        text_content = "".join(texts)
+        if text_content.strip():
+            return text_content[:limit]
+    return ""
+
+
+def messages_from_events(session_id: str, session_details: Dict[str, Any]) -> List[Dict[str, str]]:
+    """Converte gli eventi di sessione in messaggi {role, content} per la UI."""
+    events = session_details.get('events', [])
+    return flatten_events(session_id, len(events), events)
+
+
+def render_session_table(
+    sessions: List[Dict[str, Any]],
+    previews: Optional[Dict[str, str]] = None,
+    fallback: str = "Unknown",
+) -> Optional[str]:
+    """Tabella sessioni con selezione a riga singola; ritorna l'id selezionato.
+
+    Due widget (tabella + bottone elimina) invece di 2*N bottoni: il costo di
+    ricostruzione del widget-graph della sidebar resta costante al crescere
+    delle sessioni.
+    """
+    ids: List[str] = []
+    rows: List[Dict[str, str]] = []
+    for i, session in enumerate(sessions):
+        session_id = session.get('id', f'session_{i}')
+        ids.append(session_id)
+        rows.append({
+            "id": session_id[:8],
+            "updated": format_timestamp(session.get('lastUpdateTime', 0), fallback=fallback),
+            "preview": (previews or {}).get(session_id, ""),
+        })
+
+    event = st.dataframe(
+        pd.DataFrame(rows),
+        hide_index=True,
+        on_select="rerun",
+        selection_mode="single-row",
+        key="session_table",
+    )
+    selected_rows = event.selection.rows if event is not None else []
+    return ids[selected_rows[0]] if selected_rows else None
+
+
+def display_conversation_history(
+    messages: List[Dict[str, str]],
+    empty_message: str = "No conversation history yet. Start by sending a message!",
+    truncation_fmt: str = "[{n} earlier messages truncated]",
+):
+    """Mostra la history della conversazione dai messaggi locali."""
+    if not messages:
+        st.info(empty_message)
+        return
+
+    if len(messages) > MAX_TURNS:
+        st.caption(truncation_fmt.format(n=len(messages) - MAX_TURNS))
+        messages = messages[-MAX_TURNS:]
+
+    for message in messages:
+        with st.chat_message(message["role"]):
+            st.write(message["content"])